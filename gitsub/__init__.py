@@ -1,21 +1,79 @@
 import os
 import sys
-import toml
+import re
+import json
+import hashlib
+import shutil
+import threading
+import configparser
 import subprocess as sp
-from typing import List, Optional, Union, Tuple, Generator
-from glob import iglob
+from typing import List, Optional, Union, Tuple, Generator, Set, Dict
 from dataclasses import dataclass, asdict
-from sty import fg
-from concurrent.futures import ProcessPoolExecutor, Future
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
 CACHEDIR = os.path.expanduser('~/.cache/gitsub')
 
+CHILD_CACHE_FILE = f'{CACHEDIR}/state.json'
+
+TOML_CACHE_DIR = f'{CACHEDIR}/toml'
+
+DEFAULT_JOBS = 8
+
+# In-process cache of parsed toml files: {path: ((mtime, size), json)}
+TOML_CACHE: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+# Matches the fetch lines of `git remote -v`, e.g.: `origin\t<url> (fetch)`
+REMOTE_RE = re.compile(r'^(\S+)\t(\S+) \(fetch\)$', re.M)
+
+# Matches the config keys that make a repo a partial clone.
+PROMISOR_RE = re.compile(r'^\s*(partialclone|promisor)\s*=', re.M | re.I)
+
+GIT_DIR_NAMES = ('.git', '.gitsub_hidden')
+
+# Accepted gitignore entries for hidden child git dirs.
+IGNORE_ENTRIES = frozenset(['.gitsub_hidden/', '**/.gitsub_hidden'])
+
+# Dirs that never contain child repos and are expensive to walk. More names
+# can be added via `GITSUB_WALK_IGNORE` (separated by `os.pathsep`).
+WALK_IGNORE_DIRS = {'node_modules', '__pycache__', 'venv'} | set(
+    filter(None, os.environ.get('GITSUB_WALK_IGNORE', '').split(os.pathsep))
+)
+
+# Git command prefix for clones/fetches into the cache dir. The cache repos
+# have no alternates or hooks and are never looked at by users, so git's
+# expensive housekeeping is switched off.
+GIT_FAST = [
+    'git',
+    '-c', 'core.alternateRefsCommand=# exit 0',
+    '-c', 'fetch.showForcedUpdates=false',
+    '-c', 'fetch.writeCommitGraph=false',
+    '-c', 'gc.auto=0',
+]
+
+# Limit for concurrent clones/fetches of remote repos, see `get_network_ops`.
+NETWORK_OPS: Optional[threading.BoundedSemaphore] = None
+
+CACHE_LOCKS: Dict[str, threading.Lock] = {}
+CACHE_LOCKS_GUARD = threading.Lock()
+
+# One `git cat-file` process per cache dir, see `get_cat_file`.
+CAT_FILES: Dict[str, 'GitCatFile'] = {}
+
 err_msg_unstaged = """
 Note: You cannot update a parent repo, as long as it contains subrepos with changes 
 that haven't been pushed to their remote locations.\n
 """
 
+err_msg_ignore = """Error: Cannot find '.gitsub_hidden/' entry in global or local '.gitignore' file.
+
+Add this line:
+
+.gitsub_hidden/
+
+to your global or local gitignore file.
+"""
+
 
 def cmd_init_parent(parent_root_absolute):
 
@@ -27,17 +85,36 @@ def cmd_init_parent(parent_root_absolute):
         open(f, 'a').close()
 
 
-def check_global_ignore():
+@lru_cache(maxsize=None)
+def ignore_file_has_entry(path: str, mtime: float) -> bool:
     """
-    Check if .gitsub_hidden globally.
+    Check if an ignore file contains a `.gitsub_hidden` entry.
+    The `mtime` arg is part of the cache key, so that changed files are
+    read again.
+    """
+
+    try:
+        with open(path, 'r') as f:
+            lines = set(line.strip() for line in f.read().splitlines())
+    except (OSError, UnicodeDecodeError):
+        return False
+
+    return not IGNORE_ENTRIES.isdisjoint(lines)
+
+
+@lru_cache(maxsize=None)
+def check_global_ignore() -> bool:
+    """
+    Check if .gitsub_hidden is ignored globally or locally.
     """
 
     r = sp.run(
         ['git', 'config', '--get', 'core.excludesfile'],
         stdout=sp.PIPE,
+        text=True,
     )
 
-    out = r.stdout.decode('utf8')
+    out = r.stdout
 
     ignore_files = ['.gitignore']
 
@@ -45,28 +122,23 @@ def check_global_ignore():
         ignore_files.append(os.path.expanduser(line))
 
     for path in ignore_files:
-        if os.path.isfile(path):
-            with open(path, 'r') as f:
-                for line in f.readlines():
-                    if line.strip() in [
-                        '.gitsub_hidden/', '**/.gitsub_hidden'
-                    ]:
-                        return
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
 
-    sys.stderr.write(
-        "Error: Cannot find '.gitsub_hidden/' entry in global or local "\
-        "'.gitignore' file."\
-        "\n\nAdd this line:\n\n.gitsub_hidden/\n\nto your global or "\
-        "local gitignore file.\n"
-    )
-    sys.exit(1)
+        if ignore_file_has_entry(path, mtime):
+            return True
 
+    return False
 
+
+@lru_cache(maxsize=None)
 def get_repo_root() -> str:
 
     cmd = ['git', 'rev-parse', '--show-toplevel']
 
-    r = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+    r = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
 
     if r.returncode == 128:
         pass
@@ -76,7 +148,7 @@ def get_repo_root() -> str:
         sys.stderr.write(r.stderr)
         sys.exit(1)
 
-    repo_root = r.stdout.decode('utf8').replace('\n', '')
+    repo_root = r.stdout.rstrip('\n')
 
     return repo_root or ''
 
@@ -97,8 +169,113 @@ class Parent:
     root_absolute: str
     gitsub_file: str
     locked_children: List[dict]
+    jobs: int = DEFAULT_JOBS
+
+
+def parse_toml(content: bytes) -> dict:
+    """
+    Parse toml data. Uses the stdlib parser (Python 3.11+) or `tomli` if
+    available.
+    """
 
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            import toml
+            return toml.loads(content.decode('utf8'))
+
+    return tomllib.loads(content.decode('utf8'))
+
+
+def dump_toml(data: dict) -> str:
+    """
+    Serialize data as toml. Uses `tomli_w` if available.
+    """
+
+    try:
+        import tomli_w
+    except ImportError:
+        import toml
+        return toml.dumps(data)
+
+    return tomli_w.dumps(data)
+
+
+def load_toml(path: str) -> dict:
+    """
+    Read a toml file.
+    The parsed data is cached as json, in memory keyed by the file's
+    (mtime, size) and on disk keyed by the sha1 of its content, so that
+    unchanged files don't need to be parsed as toml again.
+    Each call returns a fresh dict, which the caller may mutate.
+    """
 
+    st = os.stat(path)
+    stat_key = (st.st_mtime_ns, st.st_size)
+
+    cached = TOML_CACHE.get(path)
+
+    if cached and cached[0] == stat_key:
+        return json.loads(cached[1])
+
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    digest = hashlib.sha1(content).hexdigest()
+    path_digest = hashlib.sha1(os.path.abspath(path).encode('utf8')).hexdigest()
+    cache_file = f'{TOML_CACHE_DIR}/{path_digest}.json'
+
+    text = None
+
+    try:
+        with open(cache_file, 'r') as f:
+            if f.readline().rstrip('\n') == digest:
+                text = f.read()
+    except OSError:
+        pass
+
+    if text is None:
+        data = parse_toml(content)
+
+        try:
+            text = json.dumps(data)
+        except TypeError:
+            # Toml dates etc. can't be cached as json.
+            return data
+
+        try:
+            os.makedirs(TOML_CACHE_DIR, exist_ok=True)
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(f'{digest}\n{text}')
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+    TOML_CACHE[path] = (stat_key, text)
+
+    return json.loads(text)
+
+
+def get_jobs(gitsub_data: dict) -> int:
+    """
+    Return the max number of parallel jobs. Set via the `GITSUB_JOBS` env
+    var or `jobs` in the `[gitsub]` table of `.gitsub`.
+    """
+
+    jobs = os.environ.get('GITSUB_JOBS') or \
+        gitsub_data.get('gitsub', {}).get('jobs')
+
+    try:
+        return max(1, int(jobs))
+    except (TypeError, ValueError):
+        return DEFAULT_JOBS
+
+
+@lru_cache(maxsize=None)
 def get_parent_data(repo_root: str) -> Parent:
     """
     Create the parent data object.
@@ -106,8 +283,7 @@ def get_parent_data(repo_root: str) -> Parent:
 
     gitsub_file = f"{repo_root}/.gitsub"
 
-    with open(gitsub_file, 'r') as f:
-        gitsub_data = toml.loads(f.read())
+    gitsub_data = load_toml(gitsub_file)
 
     if not gitsub_data.get('children'):
         gitsub_data['children'] = []
@@ -116,6 +292,7 @@ def get_parent_data(repo_root: str) -> Parent:
         root_absolute=repo_root,
         gitsub_file=gitsub_file,
         locked_children=gitsub_data['children'],
+        jobs=get_jobs(gitsub_data),
     )
 
 
@@ -127,46 +304,111 @@ class Remote:
     cache_root_absolute: str
 
 
-def get_remote_locations(root_absolute: str) -> List[Remote]:
+@lru_cache(maxsize=1024)
+def parse_remote_url(url: str) -> Tuple[str, str, str]:
     """
-    Gather all registered remote locations for a git repo.
+    Split a remote url into `(host, user, repo_name)`, e.g.:
+    `git@github.com:feluxe/gitsub.git` -> `git@github.com, feluxe, gitsub.git`
+    """
+
+    host, user, repo_name = url.replace(':', '/').rsplit('/', 3)[-3:]
+
+    return host, user, repo_name
+
+
+@lru_cache(maxsize=1024)
+def get_remote_cache_root(url: str) -> str:
+    """
+    Return the cache dir of a remote url.
+    """
+
+    remote_host, remote_user, remote_repo_name = parse_remote_url(url)
+
+    return f'{CACHEDIR}/{remote_host}/{remote_user}/{remote_repo_name}'
+
+
+@lru_cache(maxsize=None)
+def has_url_rewrites() -> bool:
+    """
+    Check if the user's git config rewrites remote urls (`url.*.insteadOf`).
     """
 
     r = sp.run(
-        ['git', 'remote', '-v'],
-        cwd=root_absolute,
+        ['git', 'config', '--get-regexp', r'^url\..*\.(push)?insteadof$'],
         stdout=sp.PIPE,
+        text=True,
     )
 
-    out = r.stdout.decode('utf8')
+    return bool(r.stdout.strip())
+
+
+def read_config_remotes(root_absolute: str) -> Optional[List[Tuple[str, str]]]:
+    """
+    Read `(name, url)` of all remotes directly from a repo's `.git/config`,
+    without running git.
+    Returns None if the config uses features that need git to resolve them
+    (includes, url rewrites).
+    """
+
+    try:
+        with open(f'{root_absolute}/.git/config', 'r') as f:
+            text = f.read()
+    except OSError:
+        return None
+
+    lowered = text.lower()
+
+    if '[include' in lowered or 'insteadof' in lowered:
+        return None
+
+    parser = configparser.RawConfigParser(strict=False)
+
+    try:
+        parser.read_string(text)
+    except configparser.Error:
+        return None
 
     remotes = []
 
-    if out:
-        for line in out.splitlines():
-            if line[-8:] == ' (fetch)':
+    for section in parser.sections():
+        if section.startswith('remote "') and section.endswith('"') \
+                and parser.has_option(section, 'url'):
+            remotes.append((section[8:-1], parser.get(section, 'url')))
+
+    return remotes
+
+
+def get_remote_locations(root_absolute: str) -> List[Remote]:
+    """
+    Gather all registered remote locations for a git repo.
+    """
+
+    remote_urls = None
 
-                remote_str = line[:-8]
-                remote_split = remote_str.split('\t')
+    if not has_url_rewrites():
+        remote_urls = read_config_remotes(root_absolute)
 
-                remote_name = remote_split[0]
-                remote_url = remote_split[1]
+    if remote_urls is None:
+        r = sp.run(
+            ['git', 'remote', '-v'],
+            cwd=root_absolute,
+            stdout=sp.PIPE,
+            text=True,
+        )
+        remote_urls = [m.groups() for m in REMOTE_RE.finditer(r.stdout)]
 
-                split_url = remote_url.replace(':', '/').split('/')
-                remote_host = split_url[-3]
-                remote_user = split_url[-2]
-                remote_repo_name = split_url[-1]
+    remotes = []
 
-                root = f'{CACHEDIR}/{remote_host}/{remote_user}/{remote_repo_name}'
+    for remote_name, remote_url in remote_urls:
 
-                remote = Remote(
-                    name=remote_name,
-                    url=remote_url,
-                    is_ssh=remote_url.startswith('http') == False,
-                    cache_root_absolute=root,
-                )
+        remote = Remote(
+            name=remote_name,
+            url=remote_url,
+            is_ssh=not remote_url.startswith('http'),
+            cache_root_absolute=get_remote_cache_root(remote_url),
+        )
 
-                remotes.append(remote)
+        remotes.append(remote)
 
     if len(remotes) < 1:
         sys.stderr.write(
@@ -187,52 +429,248 @@ class Child:
     root_absolute: str
 
 
+class GitCatFile:
+    """
+    A persistent `git cat-file --batch-check` process for a git repo.
+    Object lookups are written to its stdin one per line, so that several
+    lookups only cost a single git process. Objects that are fetched while
+    the process runs are found as well.
+    Lookups must not run concurrently.
+    """
+
+    def __init__(self, repo_root: str):
+        self.repo_root = repo_root
+        self.proc: Optional[sp.Popen] = None
+
+    def open(self) -> 'GitCatFile':
+        self.proc = sp.Popen(
+            [
+                'git', 'cat-file',
+                '--batch-check=%(objectname) %(objecttype)'
+            ],
+            cwd=self.repo_root,
+            # Never fetch missing objects of partial clones (git 2.44+).
+            env=dict(os.environ, GIT_NO_LAZY_FETCH='1'),
+            stdin=sp.PIPE,
+            stdout=sp.PIPE,
+            stderr=sp.DEVNULL,
+            text=True,
+        )
+        return self
+
+    def close(self) -> None:
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+
+    def lookup(self, rev: str) -> Tuple[str, str]:
+        """
+        Return `(objectname, objecttype)` for a rev or `('', '')` if the
+        object is missing.
+        """
+
+        self.proc.stdin.write(f'{rev}\n')
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline().split()
+
+        if len(line) != 2 or line[1] == 'missing':
+            return '', ''
+
+        return line[0], line[1]
+
+
 def get_current_branch(repo_root: str) -> str:
     """
     Return the currently active branch for a git repo.
     """
 
-    cmd = ['git', 'rev-parse', '--abbrev-ref', 'HEAD']
-    r = sp.run(cmd, stdout=sp.PIPE, cwd=repo_root)
-    branch = r.stdout.decode('utf8').replace('\n', '')
+    cmd = ['git', 'symbolic-ref', '-q', '--short', 'HEAD']
+    r = sp.run(cmd, stdout=sp.PIPE, cwd=repo_root, text=True)
+    branch = r.stdout.rstrip('\n')
 
-    return branch or ''
+    # Detached HEAD, same as `git rev-parse --abbrev-ref HEAD` reports it.
+    return branch or 'HEAD'
 
 
-def get_current_commit(repo_root: str) -> str:
+@lru_cache(maxsize=None)
+def get_head_state(repo_root: str) -> Tuple[str, str]:
     """
-    Return the currently active commit hash for a git repo.
+    Return the currently active `(branch, commit)` for a git repo, using a
+    single git process.
     """
 
-    cmd = ['git', 'rev-parse', '--verify', 'HEAD']
-    r = sp.run(cmd, stdout=sp.PIPE, cwd=repo_root)
-    commit = r.stdout.decode('utf8').replace('\n', '')
+    cmd = ['git', 'rev-parse', 'HEAD', '--abbrev-ref', 'HEAD']
+    r = sp.run(cmd, stdout=sp.PIPE, stderr=sp.DEVNULL, cwd=repo_root, text=True)
+
+    # Unborn branch, HEAD can't be resolved yet.
+    if r.returncode != 0:
+        return get_current_branch(repo_root), ''
+
+    commit, branch = r.stdout.split()
+
+    return branch, commit
+
+
+def get_child_fingerprint(root_absolute: str) -> Optional[str]:
+    """
+    Return a fingerprint of the git files that the child data is derived
+    from (HEAD, the ref it points to, packed-refs and config).
+    Git updates these files by renaming a lock file over them, so the inode
+    is part of the fingerprint. The mtime alone may not change on file
+    systems with coarse timestamps.
+    Returns None if the child's git dir can't be fingerprinted.
+    """
+
+    git_dir = f'{root_absolute}/.git'
+    head_file = f'{git_dir}/HEAD'
+
+    try:
+        with open(head_file, 'r') as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+
+    paths = [head_file, f'{git_dir}/packed-refs', f'{git_dir}/config']
 
-    return commit or ''
+    if head.startswith('ref: '):
+        paths.append(f'{git_dir}/{head[5:]}')
 
+    stats = []
 
-def get_child_data(parent: Parent, root_relative: str) -> Child:
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats.append(f'{st.st_mtime_ns}.{st.st_ino}.{st.st_size}')
+        except OSError:
+            stats.append('-')
+
+    return f'{head}:' + ':'.join(stats)
+
+
+def load_child_cache() -> dict:
+    """
+    Load the cached child data of previous runs from `CHILD_CACHE_FILE`.
+    """
+
+    try:
+        with open(CHILD_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def prune_child_cache(parent: Parent, cache: dict, seen: Set[str]) -> None:
+    """
+    Remove the cached data of children of a parent repo that weren't found
+    in the current run.
+    """
+
+    prefix = f'{parent.root_absolute}/'
+
+    for root_absolute in list(cache):
+        if root_absolute.startswith(prefix) and root_absolute not in seen:
+            del cache[root_absolute]
+
+
+def save_child_cache(cache: dict) -> None:
+    """
+    Save the cached child data to `CHILD_CACHE_FILE`.
+    """
+
+    tmp_file = f'{CHILD_CACHE_FILE}.{os.getpid()}.tmp'
+
+    try:
+        os.makedirs(CACHEDIR, exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, CHILD_CACHE_FILE)
+    except OSError:
+        pass
+
+
+def get_child_data(
+    parent: Parent,
+    root_relative: str,
+    cache: Optional[dict] = None,
+) -> Child:
     """
     Create child data object for each given child.
+    If a cache is given, children whose git files haven't changed since the
+    last run are taken from the cache instead of asking git.
     """
 
     root_absolute = f'{parent.root_absolute}/{root_relative}'
 
+    fingerprint = get_child_fingerprint(root_absolute)
+
+    if cache is not None and fingerprint:
+        cached = cache.get(root_absolute)
+
+        if cached and cached['fingerprint'] == fingerprint:
+            data = cached['child']
+            return Child(
+                current_branch=data['current_branch'],
+                current_commit=data['current_commit'],
+                remotes=[Remote(**r) for r in data['remotes']],
+                root_absolute=root_absolute,
+                root_relative=root_relative,
+            )
+
     remotes = get_remote_locations(root_absolute)
 
+    current_branch, current_commit = get_head_state(root_absolute)
+
     child = Child(
-        current_branch=get_current_branch(root_absolute),
-        current_commit=get_current_commit(root_absolute),
+        current_branch=current_branch,
+        current_commit=current_commit,
         remotes=remotes,
         root_absolute=root_absolute,
         root_relative=root_relative,
     )
 
+    if cache is not None and fingerprint:
+        cache[root_absolute] = {
+            'fingerprint': fingerprint,
+            'child': asdict(child),
+        }
+
     return child
 
 
+def collect_dirty_paths(parent: Parent) -> Set[str]:
+    """
+    Collect all paths of a parent repo that have changes, using a single
+    `git status` run for the whole parent.
+    """
+
+    cmd = ['git', 'status', '--porcelain', '-z', '-uall']
+    r = sp.run(cmd, cwd=parent.root_absolute, stdout=sp.PIPE, text=True)
+
+    # With `-z` paths are NUL separated and never quoted. Renames and copies
+    # (in either the index or the worktree column) are followed by an extra
+    # entry for their original path.
+    entries = iter(r.stdout.split('\0'))
+
+    dirty_paths = set()
+
+    for entry in entries:
+        if not entry:
+            continue
+
+        dirty_paths.add(entry[3:])
+
+        if 'R' in entry[:2] or 'C' in entry[:2]:
+            dirty_paths.add(next(entries, ''))
+
+    dirty_paths.discard('')
+
+    return dirty_paths
+
+
 def has_child_changes_in_parent(
-    parent: Parent,
+    dirty_paths: Set[str],
     child: Child,
 ) -> bool:
     """
@@ -241,14 +679,12 @@ def has_child_changes_in_parent(
     run any further check.
     """
 
-    cmd = ['git', 'status', '-s', child.root_relative]
-    r = sp.run(cmd, cwd=parent.root_absolute, stdout=sp.PIPE)
-    out = r.stdout.decode('utf8').replace('\n', '')
+    prefix = child.root_relative.rstrip('/') + '/'
 
-    if out:
-        return True
-    else:
-        return False
+    return any(
+        path == child.root_relative or path.startswith(prefix)
+        for path in dirty_paths
+    )
 
 
 def has_child_unpushed_changes(parent: Parent, child: Child):
@@ -256,73 +692,281 @@ def has_child_unpushed_changes(parent: Parent, child: Child):
     Check if the child repo itself has unpushed changes.
     """
 
-    cmd = ['git', 'status', '-s']
+    # Only the presence of output matters, so it's not decoded.
+    cmd = ['git', 'status', '--porcelain', '-z']
     r = sp.run(cmd, cwd=child.root_absolute, stdout=sp.PIPE)
-    changes = r.stdout.decode('utf8').replace('\n', '')
 
-    if changes != '':
+    if r.stdout:
         sys.stderr.write(f"\nUnstaged Changes in: {child.root_relative}\n")
         return True
     else:
         return False
 
 
-def commit_exists(repo_root, commit):
+def commit_exists(cat_file: GitCatFile, commit: str) -> bool:
     """
     Check if a commit hash exists in a git repo.
     """
 
-    cmd = ['git', 'cat-file', '-t', commit]
-    r = sp.run(cmd, cwd=repo_root, stdout=sp.PIPE, stderr=sp.PIPE)
-    out = r.stdout.decode('utf8').replace('\n', '')
+    _, obj_type = cat_file.lookup(commit)
 
-    if out == 'commit':
+    if obj_type == 'commit':
         return True
     else:
         return False
 
 
-def check_child_commit_exist_in_remote(parent: Parent, child: Child):
+@lru_cache(maxsize=None)
+def get_session():
     """
-    Check if a commit exists in a remote repository.
-    This clones/fetches the remote repo into a cache dir and checks for the
-    commit in there.
+    Return a shared HTTP session, so that concurrent remote probes reuse
+    connections.
     """
 
-    for remote in child.remotes:
+    # Imported here, so that plain git commands don't pay for the import.
+    import requests
+    from requests.adapters import HTTPAdapter
 
-        if not os.path.exists(remote.cache_root_absolute):
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+    session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
-            print(
-                f"{fg.li_black}Gitsub: Clone repo into cache-dir for: {child.root_relative}{fg.rs} "
-            )
+    return session
 
-            cmd = ['git', 'clone', remote.url, remote.cache_root_absolute]
-            sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
 
-        print(
-            f"{fg.li_black}Gitsub: Update cached remote-repo for: {child.root_relative}{fg.rs}"
-        )
+@lru_cache(maxsize=None)
+def probe_remote(url: str) -> int:
+    """
+    Return the HTTP status code of a remote url.
+    This probes the git smart-HTTP endpoint, which answers `200` only if the
+    repo can be read without login data.
+    Returns `0` if the remote cannot be reached via HTTP (e.g. ssh urls).
+    """
+
+    import requests
 
-        if remote.is_ssh == True:
-            cmd = ['git', 'remote', 'set-url', 'origin', remote.url]
-            sp.run(cmd, stdout=sp.PIPE, cwd=remote.cache_root_absolute)
+    probe_url = f"{url.rstrip('/')}/info/refs?service=git-upload-pack"
 
-        sp.run(
-            ['git', 'fetch', 'origin', child.current_branch],
-            cwd=remote.cache_root_absolute,
+    try:
+        r = get_session().head(probe_url, allow_redirects=True, timeout=5)
+    except requests.exceptions.RequestException:
+        return 0
+
+    return r.status_code
+
+
+@lru_cache(maxsize=None)
+def get_batch_ssh_command() -> Optional[str]:
+    """
+    Return the user's ssh command with prompts (passwords, passphrases, host
+    keys) switched off.
+    Returns None if ssh is configured via `GIT_SSH`, which takes a program
+    rather than a command line.
+    """
+
+    ssh_command = os.environ.get('GIT_SSH_COMMAND')
+
+    if not ssh_command:
+        if os.environ.get('GIT_SSH'):
+            return None
+
+        r = sp.run(
+            ['git', 'config', '--get', 'core.sshCommand'],
             stdout=sp.PIPE,
-            stderr=sp.PIPE
+            text=True,
         )
+        ssh_command = r.stdout.strip() or 'ssh'
 
-        if not commit_exists(remote.cache_root_absolute, child.current_commit):
-            sys.stderr.write(
-                f"\n    Current commit cannot be found on remote for: {child.root_relative}\n"
-            )
+    return f'{ssh_command} -o BatchMode=yes'
+
+
+def is_remote_ref_tip(url: str, commit: str) -> bool:
+    """
+    Check if a commit is the tip of a branch or tag of a remote repo.
+    This only asks the remote for its refs, no objects are transferred.
+    Other refs (e.g. `refs/pull/*`) are ignored, since a clone doesn't get
+    them.
+    Git and ssh never prompt for login data here, remotes that require it
+    are left to the fetch.
+    """
+
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+
+    if not url.startswith('http'):
+        ssh_command = get_batch_ssh_command()
+
+        if ssh_command is None:
             return False
-        else:
+
+        env['GIT_SSH_COMMAND'] = ssh_command
+
+    cmd = ['git', 'ls-remote', '--exit-code', '--heads', '--tags', url]
+    r = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, env=env, text=True)
+
+    if r.returncode != 0:
+        return False
+
+    out = r.stdout
+
+    return any(line.split('\t')[0] == commit for line in out.splitlines())
+
+
+def get_cache_lock(cache_root_absolute: str) -> threading.Lock:
+    """
+    Return the lock for a remote cache dir.
+    """
+
+    with CACHE_LOCKS_GUARD:
+        return CACHE_LOCKS.setdefault(cache_root_absolute, threading.Lock())
+
+
+def get_network_ops(parent: Parent) -> threading.BoundedSemaphore:
+    """
+    Return the semaphore that limits concurrent clones/fetches to the max
+    number of parallel jobs of the parent repo (see `get_jobs`).
+    """
+
+    global NETWORK_OPS
+
+    with CACHE_LOCKS_GUARD:
+        if NETWORK_OPS is None:
+            NETWORK_OPS = threading.BoundedSemaphore(parent.jobs)
+
+        return NETWORK_OPS
+
+
+def is_promisor_repo(repo_root: str) -> bool:
+    """
+    Check if a cache dir is a partial clone, as made by `--filter` clones or
+    fetches. Git fetches missing objects of these lazily, even for plain
+    lookups.
+    """
+
+    for config_file in [f'{repo_root}/config', f'{repo_root}/.git/config']:
+        try:
+            with open(config_file, 'r') as f:
+                if PROMISOR_RE.search(f.read()):
+                    return True
+        except OSError:
+            continue
+
+    return False
+
+
+def update_remote_cache(child: Child, remote: Remote) -> None:
+    """
+    Clone a remote repo into its cache dir or fetch the child's current
+    branch, if it's already there.
+    """
+
+    from sty import fg
+
+    # Partial clones are replaced, so that lookups in the cache never touch
+    # the network.
+    if is_promisor_repo(remote.cache_root_absolute):
+        shutil.rmtree(remote.cache_root_absolute, ignore_errors=True)
+
+    if not os.path.exists(remote.cache_root_absolute):
+
+        print(
+            f"{fg.li_black}Gitsub: Clone repo into cache-dir for: {child.root_relative}{fg.rs} "
+        )
+
+        # The cache is only used to look up commits, so a bare clone is
+        # enough. It's not a partial clone (`--filter`), since git would
+        # fetch missing commits lazily when they are looked up.
+        cmd = GIT_FAST + [
+            'clone', '--bare', remote.url, remote.cache_root_absolute
+        ]
+        sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+
+    print(
+        f"{fg.li_black}Gitsub: Update cached remote-repo for: {child.root_relative}{fg.rs}"
+    )
+
+    # Fetching by url makes sure that the current url is used, without
+    # running `git remote set-url` first.
+    sp.run(
+        GIT_FAST + ['fetch', '--no-tags', remote.url, child.current_branch],
+        cwd=remote.cache_root_absolute,
+        stdout=sp.PIPE,
+        stderr=sp.PIPE
+    )
+
+
+def get_cat_file(repo_root: str) -> GitCatFile:
+    """
+    Return the `git cat-file` process of a cache dir. It's started on first
+    use and kept running until `close_cat_files` is called.
+    The caller must hold the lock of the cache dir (see `get_cache_lock`).
+    """
+
+    with CACHE_LOCKS_GUARD:
+        if repo_root not in CAT_FILES:
+            CAT_FILES[repo_root] = GitCatFile(repo_root).open()
+
+        return CAT_FILES[repo_root]
+
+
+def close_cat_files() -> None:
+    """
+    Stop the `git cat-file` processes of all cache dirs.
+    """
+
+    with CACHE_LOCKS_GUARD:
+        for cat_file in CAT_FILES.values():
+            cat_file.close()
+
+        CAT_FILES.clear()
+
+
+def is_commit_in_cache(remote: Remote, commit: str) -> bool:
+    """
+    Check if a commit exists in the cache dir of a remote.
+    The caller must hold the lock of the cache dir.
+    """
+
+    if not os.path.isdir(remote.cache_root_absolute) or \
+            is_promisor_repo(remote.cache_root_absolute):
+        return False
+
+    return commit_exists(get_cat_file(remote.cache_root_absolute), commit)
+
+
+def check_child_commit_exist_in_remote(parent: Parent, child: Child):
+    """
+    Check if a commit exists in a remote repository.
+    If the commit is not the tip of a remote ref, this clones/fetches the
+    remote repo into a cache dir and checks for the commit in there.
+    """
+
+    for remote in child.remotes:
+
+        # Children that share a remote also share its cache dir and its
+        # `git cat-file` process, so only one of them may use it at a time.
+        cache_lock = get_cache_lock(remote.cache_root_absolute)
+
+        # A previous run may have fetched the commit already.
+        with cache_lock:
+            if is_commit_in_cache(remote, child.current_commit):
+                return True
+
+        # Usually the commit was just pushed and is the tip of a branch.
+        if is_remote_ref_tip(remote.url, child.current_commit):
             return True
 
+        with cache_lock:
+            with get_network_ops(parent):
+                update_remote_cache(child, remote)
+
+            if is_commit_in_cache(remote, child.current_commit):
+                return True
+
+    sys.stderr.write(
+        f"\n    Current commit cannot be found on remote for: {child.root_relative}\n"
+    )
+    return False
+
 
 def rename_git_dir(repo_root, from_='', to=''):
     """
@@ -332,22 +976,45 @@ def rename_git_dir(repo_root, from_='', to=''):
     src = f'{repo_root}/{from_}'
     dst = f'{repo_root}/{to}'
 
-    if os.path.exists(src):
-        os.rename(src, dst)
+    try:
+        os.replace(src, dst)
+    except FileNotFoundError:
+        pass
 
 
-def lock_children(parent: Parent, child: Child) -> None:
+def rename_git_dirs(children: List[Child], from_='', to='') -> None:
     """
-    Save gathered child data in `parent/.gitsub` (toml).
+    Rename the git dir of each child (see `rename_git_dir`).
+    """
+
+    for child in children:
+        rename_git_dir(child.root_absolute, from_, to)
+
+
+def load_lock(parent: Parent) -> dict:
+    """
+    Load the lock data from `parent/.gitsub` (toml).
+    The locked children are keyed by their `root_relative` path.
     """
 
-    with open(parent.gitsub_file, 'r') as f:
-        lock_data = toml.loads(f.read())
+    lock_data = load_toml(parent.gitsub_file)
 
-    if not lock_data.get('children'):
-        lock_data['children'] = []
+    locked_children = {}
 
-    updated_child_data = {
+    for c in lock_data.get('children') or []:
+        locked_children.setdefault(c.get('root_relative'), c)
+
+    lock_data['children'] = locked_children
+
+    return lock_data
+
+
+def update_lock_entry(lock_data: dict, child: Child) -> None:
+    """
+    Update the lock data of a single child.
+    """
+
+    lock_data['children'][child.root_relative] = {
         'root_relative': child.root_relative,
         'branch': child.current_branch,
         'commit': child.current_commit,
@@ -357,143 +1024,224 @@ def lock_children(parent: Parent, child: Child) -> None:
         } for r in child.remotes],
     }
 
-    indexes = [
-        i for i, c in enumerate(lock_data['children'])
-        if c.get('root_relative') == child.root_relative
-    ]
 
-    if len(indexes) > 1:
-        for i in indexes[1:]:
-            lock_data['children'].pop(i)
+def save_lock(parent: Parent, lock_data: dict) -> None:
+    """
+    Save gathered child data in `parent/.gitsub` (toml).
+    """
 
-    if len(indexes) == 0:
-        lock_data['children'].append(updated_child_data)
-    else:
-        lock_data['children'][indexes[0]] = updated_child_data
+    lock_data = dict(
+        lock_data,
+        children=list(lock_data['children'].values()),
+    )
 
     with open(parent.gitsub_file, 'w') as f:
-        f.write(toml.dumps(lock_data))
+        f.write(dump_toml(lock_data))
 
 
-def get_children_from_fs(parent: Parent) -> Generator[Child, None, None]:
+def walk_git_dirs(root: str = '') -> Generator[str, None, None]:
     """
-    A generator searching for `.git`/`.gitsub_hidden` dirs.
-    It also runs some paht validation checks and renames `.gitsub_hidden` to 
-    `.git`.
+    Walk a directory tree and yield the paths of all `.git`/`.gitsub_hidden`
+    dirs (relative to the cwd).
+    Hidden dirs and dirs in `WALK_IGNORE_DIRS` are not descended into.
     """
 
-    for git_dir_path in iglob('**/.git*', recursive=True):
+    try:
+        entries = list(os.scandir(root or '.'))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return
+
+    for entry in entries:
 
-        # Skip the parent repo.
-        if git_dir_path == '.git':
+        if not entry.is_dir(follow_symlinks=False):
             continue
 
-        if git_dir_path.split('.')[-1] not in ['git', 'gitsub_hidden']:
+        path = f'{root}/{entry.name}' if root else entry.name
+
+        if entry.name in GIT_DIR_NAMES:
+            yield path
+            continue
+
+        if entry.name.startswith('.') or entry.name in WALK_IGNORE_DIRS:
             continue
 
-        if os.path.isfile(git_dir_path):
+        yield from walk_git_dirs(path)
+
+
+def discover_children_on_fs() -> List[Tuple[str, bool]]:
+    """
+    Search for `.git`/`.gitsub_hidden` dirs of children.
+    Returns `(root_relative, is_hidden)` for each child. Nothing is renamed
+    here.
+    """
+
+    discovered = []
+
+    for git_dir_path in walk_git_dirs():
+
+        # Skip the parent repo.
+        if git_dir_path == '.git':
             continue
 
-        child_root_relative = git_dir_path\
-            .replace('/.gitsub_hidden', '')\
-            .replace('/.git', '')
+        child_root_relative, git_dir_name = git_dir_path.rsplit('/', 1)
+
+        is_hidden = git_dir_name == '.gitsub_hidden'
+
+        discovered.append((child_root_relative, is_hidden))
+
+    return discovered
+
 
-        if '.gitsub_hidden' in git_dir_path:
+def get_children_from_fs(parent: Parent) -> List[Child]:
+    """
+    Search for `.git`/`.gitsub_hidden` dirs and gather the data of each child.
+    It also renames `.gitsub_hidden` to `.git`.
+    """
+
+    discovered = discover_children_on_fs()
+
+    # Unhide only after the walk is done, so the tree doesn't change while
+    # it's being walked.
+    for child_root_relative, is_hidden in discovered:
+        if is_hidden:
             rename_git_dir(child_root_relative, '.gitsub_hidden', '.git')
 
-        child = get_child_data(parent, child_root_relative)
+    children_root_relative = [root_relative for root_relative, _ in discovered]
 
-        yield child
+    if not children_root_relative:
+        return []
 
+    # Gathering child data is all waiting on git subprocesses, so threads
+    # are good enough here.
+    max_workers = min(parent.jobs, len(children_root_relative))
 
-def validate_children(
+    cache = load_child_cache()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        children = list(
+            executor.map(
+                lambda root_relative: get_child_data(
+                    parent, root_relative, cache
+                ),
+                children_root_relative,
+            )
+        )
+
+    prune_child_cache(
+        parent, cache, set(child.root_absolute for child in children)
+    )
+    save_child_cache(cache)
+
+    return children
+
+
+def check_child(
     parent: Parent,
-    children: Generator[Child, None, None],
-) -> List[Child]:
+    child: Child,
+    parallel_remote: bool,
+) -> str:
     """
-    Check if children are good enough for the parent to commit their files.
+    Run all checks for a single child that can run in parallel.
+    Returns 'unstaged' or 'missing' if a check failed, 'sequential' if the
+    remote check must run sequentially (e.g. it requires login data from the
+    user) and 'ok' otherwise.
     """
 
-    all_children = []  # gather children from the generator here for later use.
+    # Check2: Has child-repo unpushed changes?
+    if has_child_unpushed_changes(parent, child):
+        return 'unstaged'
 
-    with ProcessPoolExecutor() as executor:
+    # Check3: Check if current commit exists in remote repo?
+    # This is for repos that require no login data from the user.
+    if not parallel_remote or probe_remote(child.remotes[0].url) != 200:
+        return 'sequential'
 
-        # Check1 (in parallel): Has child changes in parent?
+    if not check_child_commit_exist_in_remote(parent, child):
+        return 'missing'
 
-        futures = []
+    return 'ok'
 
-        for child in children:
 
-            all_children.append(child)
+def validate_children(
+    parent: Parent,
+    children: List[Child],
+) -> List[Child]:
+    """
+    Check if children are good enough for the parent to commit their files.
+    """
+
+    all_children = list(children)
 
-            f: Future = executor.submit(
-                has_child_changes_in_parent, parent, child
-            )
-            futures.append((f, child))
+    # Check1: Has child changes in parent?
 
-        children_filtered = [
-            child for f, child in futures if f.result() == True
-        ]
+    dirty_paths = collect_dirty_paths(parent)
+
+    children_filtered = [
+        child for child in all_children
+        if has_child_changes_in_parent(dirty_paths, child)
+    ]
 
-        # Check2 (in parallel): Has child-repo unpushed changes?
+    if not children_filtered:
+        return all_children
 
-        futures = []
+    # A single child is checked inline, a pool would only add overhead.
 
-        for child in children_filtered:
-            f = executor.submit(has_child_unpushed_changes, parent, child)
-            futures.append((f, child))
+    if len(children_filtered) == 1:
+        child = children_filtered[0]
 
-        if any([f.result() for f, child in futures]):
+        if has_child_unpushed_changes(parent, child):
             sys.stderr.write(err_msg_unstaged)
             sys.exit(1)
 
-        futures = []
+        if not check_child_commit_exist_in_remote(parent, child):
+            sys.stderr.write(err_msg_unstaged)
+            sys.exit(1)
+
+        return all_children
 
-        for child in children_filtered:
-            f = executor.submit(requests.get, child.remotes[0].url)
-            futures.append((f, child))
+    # Check2 + Check3 (in parallel): Each child runs through all of its checks
+    # on its own, so that fast children don't wait for slow ones between the
+    # checks. Remote checks only run in parallel if there are more than 2
+    # filtered children left.
 
-        # Gather children that require no remote authentication for 'check3'
-        # (in parallel). This only happens if there are more than 2 filtered
-        # children left.
+    parallel_remote = len(children_filtered) > 2
 
-        children_parallel = []
+    parallel_keys: Set[str] = set()
 
-        if len(children_filtered) > 2:
+    max_workers = min(parent.jobs, len(children_filtered))
 
-            for f, child in futures:
-                try:
-                    r = f.result()
-                    if r.status_code == 200:
-                        children_parallel.append(child)
-                except requests.exceptions.InvalidSchema:
-                    pass
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
 
-            # Check3 (in parrallel): Check if current commit exists in remote repo?
-            # This is for repos that require no login data from the user.
+        futures = {
+            executor.submit(
+                check_child, parent, child, parallel_remote
+            ): child
+            for child in children_filtered
+        }
 
-            futures = []
-            for child in children_parallel:
-                f = executor.submit(
-                    check_child_commit_exist_in_remote, parent, child
-                )
-                futures.append((f, child))
+        for f in as_completed(futures):
+            result = f.result()
 
-            if not all([f.result() for f, child in futures]):
+            if result in ['unstaged', 'missing']:
+                for other in futures:
+                    other.cancel()
                 sys.stderr.write(err_msg_unstaged)
                 sys.exit(1)
 
-        # Check3 (sequential): This is for repos that require login data from
-        # the user.
+            if result == 'ok':
+                parallel_keys.add(futures[f].root_relative)
 
-        children_sequential = [
-            c for c in children_filtered if c not in children_parallel
-        ]
+    # Check3 (sequential): This is for repos that require login data from
+    # the user.
 
-        for child in children_sequential:
-            if not check_child_commit_exist_in_remote(parent, child):
-                sys.stderr.write(err_msg_unstaged)
-                sys.exit(1)
+    children_sequential = [
+        c for c in children_filtered if c.root_relative not in parallel_keys
+    ]
+
+    for child in children_sequential:
+        if not check_child_commit_exist_in_remote(parent, child):
+            sys.stderr.write(err_msg_unstaged)
+            sys.exit(1)
 
     return all_children
 
@@ -531,28 +1279,38 @@ def run():
     #     cmd_init_children(parent_root_absolute)
     #     return
 
-    check_global_ignore()
+    if not check_global_ignore():
+        sys.stderr.write(err_msg_ignore)
+        sys.exit(1)
 
     parent = get_parent_data(parent_root_absolute)
 
     children = get_children_from_fs(parent)
 
     if cmd in ['commit', 'check-children']:
-        children = validate_children(parent, children)
+        try:
+            children = validate_children(parent, children)
+        finally:
+            close_cat_files()
 
     elif cmd == 'add':
+        rename_git_dirs(children, '.git', '.gitsub_hidden')
+
+    if children:
+        lock_data = load_lock(parent)
+
         for child in children:
-            rename_git_dir(child.root_absolute, '.git', '.gitsub_hidden')
+            update_lock_entry(lock_data, child)
 
-    for child in children:
-        lock_children(parent, child)
+        save_lock(parent, lock_data)
 
     if cmd in ['check-children']:
         return
 
+    from sty import fg
+
     # Run Git Command
     print(f"{fg.li_black}Gitsub: Run git command.{fg.rs}")
     run_git_cmd(cmd, args)
 
-    for child in children:
-        rename_git_dir(child.root_absolute, '.gitsub_hidden', '.git')
+    rename_git_dirs(children, '.gitsub_hidden', '.git')
@@ -1,10 +1,16 @@
 import subprocess as sp
 import os
 import sys
+import time
+import atexit
 import shutil
-from cmdi import print_summary, command
-from buildlib import buildmisc, git, project, yaml
-from docopt import docopt
+import hashlib
+import pickle
+import sysconfig
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
+from typing import Optional
 
 interface = """
     Install:
@@ -25,16 +31,328 @@ interface = """
 
     Options:
     -l, --libpy <path>       Location of libpython. E.g. /usr/local/lib/
+    -f, --fresh              Remove all build caches before building and
+                             don't restore stored artifacts.
+    --parallel               Build while 'bump' runs its git steps. The git
+                             prompts then mix with the build output.
+    --force-build            Build in 'bump' even if the version didn't change.
     -h, --help               Show this screen.
 """
 
-proj = yaml.loadfile('Project')
+PROJECT_CACHE_FILE = os.path.expanduser('~/.cache/gitsub/project.pkl')
+
+
+@lru_cache(maxsize=None)
+def load_project():
+    """
+    Load the 'Project' file. The parsed data is pickled to
+    PROJECT_CACHE_FILE and reused as long as the file is unchanged.
+    """
+
+    st = os.stat('Project')
+    key = (os.path.abspath('Project'), st.st_mtime_ns, st.st_size)
+
+    try:
+        with open(PROJECT_CACHE_FILE, 'rb') as f:
+            cached_key, data = pickle.load(f)
+        if cached_key == key:
+            return data
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        pass
+
+    from buildlib import yaml
+
+    data = yaml.loadfile('Project')
+
+    try:
+        os.makedirs(os.path.dirname(PROJECT_CACHE_FILE), exist_ok=True)
+        with open(PROJECT_CACHE_FILE, 'wb') as f:
+            pickle.dump((key, data), f)
+    except (OSError, TypeError, AttributeError, pickle.PicklingError):
+        pass
+
+    return data
 
 
 class Cfg:
-    version = proj['version']
-    registry = 'mw-pypi'
-    libpy_path = '/usr/local/lib'
+    # Instance attributes only, so that a changed version never leaks into
+    # the class. 'dataclass(slots=True)' would require Python 3.10.
+    __slots__ = ('version', 'registry', 'libpy_path')
+
+    def __init__(
+        self,
+        version: Optional[str] = None,
+        registry: str = 'mw-pypi',
+        libpy_path: str = '/usr/local/lib',
+    ):
+        self.version = version or load_project()['version']
+        self.registry = registry
+        self.libpy_path = libpy_path
+
+
+BUILD_CACHE_DIR = 'build/.cache'
+
+# PyInstaller's work dir is kept outside of the project, so that its
+# analysis cache survives a clean checkout. CI should cache this dir.
+PYINSTALLER_WORK_DIR = os.environ.get('GITSUB_BUILD_CACHE') or \
+    os.path.expanduser('~/.cache/gitsub/pyinstaller-work')
+
+# Files whose content determines the build result.
+BUILD_SOURCES = ['gitsub', 'entry.py', 'Project', 'Pipfile.lock']
+
+ARTIFACTS = {
+    'pyinstaller': 'dist/pyinstaller/gitsub',
+    'nuitka': 'dist/nuitka/entry.bin',
+}
+
+
+def iter_source_files(path):
+    if os.path.isfile(path):
+        yield path
+        return
+
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.name == '__pycache__':
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_source_files(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path
+
+
+def source_fingerprint(sources=BUILD_SOURCES):
+    """
+    Combined hash of the paths and contents of all build sources.
+    """
+
+    h = hashlib.blake2b()
+    buf = bytearray(1024 * 1024)
+    view = memoryview(buf)
+
+    for source in sources:
+        if not os.path.exists(source):
+            continue
+
+        for path in iter_source_files(source):
+            h.update(path.encode('utf8') + b'\0')
+
+            with open(path, 'rb') as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    h.update(view[:n])
+
+    return h.hexdigest()
+
+
+def is_build_cached(tool, fingerprint):
+    """
+    Check if the artifact of a tool was built from the current sources.
+    """
+
+    hash_file = f'{BUILD_CACHE_DIR}/{tool}.hash'
+
+    if not os.path.isfile(ARTIFACTS[tool]):
+        return False
+
+    try:
+        with open(hash_file, 'r') as f:
+            return f.read().strip() == fingerprint
+    except OSError:
+        return False
+
+
+def save_build_hash(tool, fingerprint):
+    os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+
+    with open(f'{BUILD_CACHE_DIR}/{tool}.hash', 'w') as f:
+        f.write(fingerprint)
+
+
+# Artifacts of earlier builds, stored by source fingerprint. Switching
+# branches back and forth restores a binary instead of rebuilding it.
+ARTIFACT_STORE = os.path.expanduser('~/.cache/gitsub/artifacts')
+ARTIFACT_STORE_SIZE = 20
+
+
+def link_file(src, dst):
+    """
+    Hard link 'src' to 'dst', replacing 'dst'. Falls back to a copy if
+    both paths are on different filesystems.
+    """
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f'{dst}.tmp'
+
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+
+    os.replace(tmp, dst)
+
+
+def get_stored_artifact(tool, fingerprint):
+    name = os.path.basename(ARTIFACTS[tool])
+    return f'{ARTIFACT_STORE}/{fingerprint}/{name}'
+
+
+def restore_artifact(tool, fingerprint):
+    """
+    Link a stored artifact back into 'dist'. Returns False if there is none.
+    """
+
+    stored = get_stored_artifact(tool, fingerprint)
+
+    if not os.path.isfile(stored):
+        return False
+
+    link_file(stored, ARTIFACTS[tool])
+    # Mark the entry as recently used, atime is unreliable with 'relatime'.
+    os.utime(os.path.dirname(stored))
+
+    return True
+
+
+def store_artifact(tool, fingerprint):
+    link_file(ARTIFACTS[tool], get_stored_artifact(tool, fingerprint))
+    evict_artifacts()
+
+
+def evict_artifacts(keep=ARTIFACT_STORE_SIZE):
+    """
+    Remove the least recently used entries from the artifact store.
+    """
+
+    try:
+        entries = [e for e in os.scandir(ARTIFACT_STORE) if e.is_dir()]
+    except OSError:
+        return
+
+    entries.sort(key=lambda e: e.stat().st_atime, reverse=True)
+
+    for entry in entries[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+LIBPY_CACHE_FILE = os.path.expanduser('~/.cache/gitsub/libpy_path')
+
+# The shared libpython of the running interpreter, e.g. 'libpython3.7m.so'.
+LIBPY_NAME = f"libpython{sysconfig.get_config_var('LDVERSION')}.so"
+
+
+def has_libpython(path):
+    """
+    Check if a dir contains the shared libpython of the running interpreter.
+    Other Python versions and the static 'libpython*.a' of non-shared builds
+    are of no use to PyInstaller.
+    """
+
+    try:
+        return any(
+            e.name == LIBPY_NAME or e.name.startswith(f'{LIBPY_NAME}.')
+            for e in os.scandir(path)
+        )
+    except OSError:
+        return False
+
+
+def discover_libpython(uinput, cfg: Cfg):
+    """
+    Find the dir that contains libpython. A dir found outside of the
+    interpreter's LIBDIR is cached in LIBPY_CACHE_FILE (per interpreter) for
+    later builds.
+    """
+
+    if uinput['--libpy']:
+        return uinput['--libpy']
+
+    if os.environ.get('LD_LIBRARY_PATH'):
+        return os.environ['LD_LIBRARY_PATH']
+
+    lib_dir = sysconfig.get_config_var('LIBDIR')
+
+    if lib_dir and has_libpython(lib_dir):
+        return lib_dir
+
+    try:
+        with open(LIBPY_CACHE_FILE, 'r') as f:
+            executable, cached = f.read().splitlines()
+        if executable == sys.executable and has_libpython(cached):
+            return cached
+    except (OSError, ValueError):
+        pass
+
+    candidates = [
+        cfg.libpy_path,
+        '/usr/lib',
+        '/usr/lib/x86_64-linux-gnu',
+    ]
+
+    for path in candidates:
+        if has_libpython(path):
+            try:
+                os.makedirs(os.path.dirname(LIBPY_CACHE_FILE), exist_ok=True)
+                tmp_file = f'{LIBPY_CACHE_FILE}.{os.getpid()}.tmp'
+                with open(tmp_file, 'w') as f:
+                    f.write(f'{sys.executable}\n{path}')
+                os.replace(tmp_file, LIBPY_CACHE_FILE)
+            except OSError:
+                pass
+            return path
+
+    return cfg.libpy_path
+
+
+def run_streamed(cmd, env):
+    """
+    Run a build tool and forward its output to stdout from a background
+    thread, so that the tool never blocks on a slow terminal.
+    Returns the exit code.
+    """
+
+    env = dict(env, PYTHONUNBUFFERED='1')
+
+    proc = sp.Popen(
+        cmd, env=env, stdout=sp.PIPE, stderr=sp.STDOUT, bufsize=1 << 16
+    )
+
+    def forward():
+        # read1 returns whatever is available, so output stays live.
+        for chunk in iter(lambda: proc.stdout.read1(1 << 16), b''):
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+
+    sys.stdout.flush()
+    forwarder = threading.Thread(target=forward)
+    forwarder.start()
+
+    returncode = proc.wait()
+    forwarder.join()
+    proc.stdout.close()
+    sys.stdout.flush()
+
+    return returncode
+
+
+def command(func):
+    """
+    Same as `cmdi.command`, but cmdi is only imported when the decorated
+    function is called.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        import cmdi
+        return cmdi.command(func)(*args, **kwargs)
+
+    return wrapper
 
 
 @command
@@ -42,29 +360,66 @@ def build(uinput: dict, cfg: Cfg):
 
     tool = uinput['<tool>'] or 'pyinstaller'
 
+    if tool not in ARTIFACTS:
+        print(f"Unknown build tool: '{tool}'. Use 'pyinstaller' or 'nuitka'.")
+        return
+
+    if uinput['--fresh']:
+        shutil.rmtree(BUILD_CACHE_DIR, ignore_errors=True)
+        shutil.rmtree(PYINSTALLER_WORK_DIR, ignore_errors=True)
+
+    # Skip the build if the sources haven't changed since the last one, or
+    # restore a stored artifact of the same sources. '--fresh' forces a
+    # rebuild.
+    fingerprint = source_fingerprint()
+
+    if is_build_cached(tool, fingerprint):
+        print(f'Build cache hit, {ARTIFACTS[tool]} is up to date.')
+        return
+
+    if not uinput['--fresh'] and restore_artifact(tool, fingerprint):
+        save_build_hash(tool, fingerprint)
+        print(f'Restored {ARTIFACTS[tool]} from {ARTIFACT_STORE}.')
+        return
+
+    # The old artifact may be a hard link into the artifact store. Unlink it,
+    # so that the build can't write into a stored binary.
+    try:
+        os.remove(ARTIFACTS[tool])
+    except FileNotFoundError:
+        pass
+
     if tool == 'pyinstaller':
 
         env = os.environ.copy()
 
         # Python Libray location differs from os to os.
-        lib_path = uinput['--libpy'] or env.get('LD_LIBRARY_PATH') or \
-                    cfg.libpy_path
+        lib_path = discover_libpython(uinput, cfg)
 
         # pyinstaller requires us to set the python library path via envvar.
         if 'LD_LIBRARY_PATH' not in env:
             env['LD_LIBRARY_PATH'] = lib_path
 
-        cmd = 'pyinstaller\
-        -y --onefile\
-         --workpath build/pyinstaller\
-         --specpath build/pyinstaller\
-         --distpath dist/pyinstaller\
-         --name gitsub\
-         entry.py'
+        # Reuse PyInstaller's analysis and the compiled bytecode of previous
+        # builds (no '--clean').
+        os.makedirs(PYINSTALLER_WORK_DIR, exist_ok=True)
+        env['PYTHONPYCACHEPREFIX'] = f'{PYINSTALLER_WORK_DIR}/pycache'
+
+        cmd = [
+            'pyinstaller',
+            '-y', '--onefile',
+            '--workpath', PYINSTALLER_WORK_DIR,
+            '--specpath', 'build/pyinstaller',
+            '--distpath', 'dist/pyinstaller',
+            '--name', 'gitsub',
+            'entry.py',
+        ]
 
         try:
-            sp.run(cmd, env=env, shell=True, check=True)
-        except sp.SubprocessError as e:
+            returncode = run_streamed(cmd, env)
+            if returncode != 0:
+                raise sp.CalledProcessError(returncode, cmd)
+        except (sp.SubprocessError, OSError) as e:
             print(e)
             print(
             "\nYou may need to use the --libpy option to specify a lib dir.\n"\
@@ -72,6 +427,9 @@ def build(uinput: dict, cfg: Cfg):
             )
             sys.exit(1)
 
+        save_build_hash(tool, fingerprint)
+        store_artifact(tool, fingerprint)
+
         print(
             '\nFor installation run:\n\nsudo cp dist/pyinstaller/gitsub /usr/local/bin\n'
         )
@@ -84,13 +442,35 @@ def build(uinput: dict, cfg: Cfg):
             'system. You should compile with PyInstaller instead.\n'
         )
 
-        cmd = 'python -m nuitka\
-        --follow-imports\
-        --lto\
-        --output-dir dist/nuitka\
-        entry.py'
+        env = os.environ.copy()
 
-        sp.run(cmd, shell=True)
+        # Let Nuitka compile the generated C code through ccache, so that
+        # unchanged translation units are cache hits on rebuilds.
+        ccache = shutil.which('ccache')
+
+        if ccache:
+            env['NUITKA_CCACHE_BINARY'] = ccache
+            env.setdefault(
+                'CCACHE_DIR', os.path.expanduser('~/.cache/gitsub/ccache')
+            )
+            env.setdefault('CCACHE_COMPRESS', '1')
+        else:
+            print(
+                'WARNING: ccache not found on PATH, C files are compiled '\
+                'from scratch.\n'
+            )
+
+        cmd = [
+            'python', '-m', 'nuitka',
+            '--follow-imports',
+            '--lto',
+            '--output-dir', 'dist/nuitka',
+            'entry.py',
+        ]
+
+        if run_streamed(cmd, env) == 0:
+            save_build_hash(tool, fingerprint)
+            store_artifact(tool, fingerprint)
 
         print(
             '\nFor installation run:\n\nsudo cp dist/nuitka/entry.bin /usr/local/bin/gitsub\n'
@@ -105,13 +485,42 @@ def deploy(cfg: Cfg):
 
 def test(cfg: Cfg):
 
-    shutil.rmtree('/tmp/gitsub/', ignore_errors=True)
+    # Move the old boilerplate out of the way and delete it in the
+    # background, while the new one is copied.
+    victim = f'/tmp/gitsub.old.{os.getpid()}.{time.time_ns()}'
+
+    try:
+        os.rename('/tmp/gitsub', victim)
+    except FileNotFoundError:
+        pass
+    else:
+        cleanup = threading.Thread(
+            target=shutil.rmtree,
+            args=(victim, ),
+            kwargs={'ignore_errors': True},
+            daemon=True,
+        )
+        cleanup.start()
+        atexit.register(cleanup.join)
+
     os.makedirs('/tmp/gitsub/')
-    shutil.copytree(src='tests', dst='/tmp/gitsub/tests')
+
+    # Reflinks share the data blocks copy-on-write (btrfs/xfs), so the copy
+    # is cheap and edits in the boilerplate never touch 'tests'.
+    try:
+        sp.run(
+            ['cp', '-a', '--reflink=auto', 'tests', '/tmp/gitsub/tests'],
+            check=True,
+        )
+    except (sp.SubprocessError, OSError):
+        shutil.rmtree('/tmp/gitsub/tests', ignore_errors=True)
+        shutil.copytree(src='tests', dst='/tmp/gitsub/tests')
+
     print('Created test boilerplate directory at: /tmp/gitsub/tests')
 
 
 def bump(uinput, cfg: Cfg):
+    from buildlib import buildmisc, git, project
 
     results = []
 
@@ -128,19 +537,43 @@ def bump(uinput, cfg: Cfg):
 
         results.extend([r1, r2])
 
-    new_release = cfg.version != proj['version']
+    new_release = cfg.version != load_project()['version']
 
-    results.extend(git.seq.bump_git(cfg.version, new_release))
+    # Without a new version the binary would be the same as before.
+    if not new_release and not uinput['--force-build']:
+        print('No version change, skipping build (use --force-build).')
+        results.extend(git.seq.bump_git(cfg.version, new_release))
+        return results
 
-    build(uinput, cfg)
+    # The git steps prompt the user and 'git add' must not pick up half
+    # written build files, so the build runs after them by default.
+    if not uinput['--parallel']:
+        results.extend(git.seq.bump_git(cfg.version, new_release))
+        build(uinput, cfg)
+        return results
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        git_future = executor.submit(git.seq.bump_git, cfg.version, new_release)
+        build_future = executor.submit(build, uinput, cfg)
+
+        for f in as_completed([git_future, build_future]):
+            if f is git_future:
+                results.extend(f.result())
+            else:
+                f.result()
 
     return results
 
 
 def run():
+    from docopt import docopt
 
-    cfg = Cfg()
+    # Parsed first, so that '-h' doesn't load anything else.
     uinput = docopt(interface)
+
+    from cmdi import print_summary
+
+    cfg = Cfg()
     results = []
 
     if uinput['build']:
@@ -153,6 +586,7 @@ def run():
         results.append(test(cfg))
 
     if uinput['git']:
+        from buildlib import git
         results.append(git.seq.bump_git(cfg.version, new_release=False))
 
     if uinput['bump']: